@@ -1,30 +1,32 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # As time goes by and jobs are killed or cancelled, files get orphaned in
 # /dev/shm and tie-up valuable memory.  This script builds a list of first-level
-# entities under /dev/shm, filtering by various criteria.  Next, lsof is used
-# to generate a list of all in-use entities under /dev/shm (retaining just the
-# first-level-deep path).  Anything in the first set that's not present in the
-# second set is removed.
+# entities under /dev/shm, filtering by various criteria.  Next, the open files
+# and memory maps of every process under /proc (or lsof, where /proc is not
+# available) are used to generate a list of all in-use entities under /dev/shm
+# (retaining just the first-level-deep path).  Anything in the first set that's
+# not present in the second set is removed.
 #
 # The filtering is defined in the devShmPathShouldInclude() function.  Right
 # now the criteria are:
 #
 #     - one of st_{mtime,ctime,atime} are newer than the cutoff timestamp
 #
-# If the criteria are met, False is returned and the first-level path in
-# question is added to an exclusion set.  Otherwise, it is added to an
-# inclusion set.
+# If the criteria are met for any file under a first-level entity, that entity
+# is excluded and the rest of its subtree is not examined.  Otherwise, it is
+# added to an inclusion set.
 #
 # Some files should be treated such that they MUST be open to be retained, or
 # at least be opened and have a very limited window for atime/mtime to affect
-# their exclusion.  We call these "special treatment" cases, and their
-# cutoff timestamp is always 1 hour ago.  A CLI flag allows special treatment
+# their exclusion.  We call these "special treatment" cases; they are
+# identified by the name of the first-level entity, and their cutoff
+# timestamp is always 1 hour ago.  A CLI flag allows special treatment
 # to be disabled.
 #
-# Once the two sets are generated, the set difference produces the first-level
-# paths that are okay for removal according to our criteria.
+# Once the inclusion and in-use sets are generated, the set difference produces
+# the first-level paths that are okay for removal according to our criteria.
 #
 # Copyright © 2018
 # Dr. Jeffrey Frey
@@ -37,97 +39,223 @@ import argparse
 import logging
 import re
 import time
-import sets
+import errno
+import shutil
 import subprocess
+import signal
+import threading
+import concurrent.futures
 
-try:
-	test_set = set()
-	def newSet():
-		return set()
-except:
-	try:
-		import sets
-		def newSet():
-			return sets.Set()
-	except:
-		sys.stdout.write('FATAL ERROR:  no set class available in this Python interpreter\n')
-		sys.exit(1)
+# Number of seconds that special-treatments files must be newer than:
+special_cutoff_threshold = 3600
 
-#
-##
-#
+# Special-treatment files are identified by these name prefixes:
+special_treatment_prefixes = (b'psm2_shm', b'vader_segment')
 
-# Will get set after CLI args are processed:
-firstLevelDevShmRegex = None
+# Special-treatment can be disabled from the command line:
+is_special_treatment_enabled = True
 
-def firstLevelDevShmPath(path):
-	m = firstLevelDevShmRegex.match(path)
-	if m:
-		return m.group(1)
-	raise ValueError('invalid path to firstLevelDevShmPath: ' + path)
+# Flags used to open directories in the subtree of a first-level entity:
+subtree_dir_open_flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
 
 #
-##
+# The predicate is handed a DirEntry from the scan of /dev/shm:  its stat()
+# result is cached, so each entry costs at most one lstat().  Symlinks are
+# not followed, a link's own timestamps are what count.  An entry that has
+# vanished since it was listed yields None:  it is neither included nor
+# excluded.
 #
+def devShmPathShouldInclude(entry, cutoff):
+	try:
+		s = entry.stat(follow_symlinks=False)
+	except FileNotFoundError:
+		return None
+	return not (s.st_mtime > cutoff or s.st_ctime > cutoff or s.st_atime > cutoff)
+
+def makeDevShmEntityShouldInclude(cutoff_timestamp, special_cutoff_timestamp):
+	# Returns a devShmEntityShouldInclude() specialized for one scan:  the
+	# cutoffs and the special-treatment setting are bound into the closure
+	# once.
+	special_prefixes = special_treatment_prefixes if is_special_treatment_enabled else None
+
+	def devShmEntityShouldInclude(top_entry):
+		# Classify a first-level entity (a DirEntry from the scan of
+		# /dev/shm) in one call:  True if it should be included.  A
+		# directory whose own timestamps are new but that contains no
+		# files is not included.
+		#
+		# Special treatment is a property of the first-level entity, so the
+		# cutoff it and all of its descendants are held to is chosen once:
+		if special_prefixes and top_entry.name.startswith(special_prefixes):
+			cutoff = special_cutoff_timestamp
+		else:
+			cutoff = cutoff_timestamp
+		if not top_entry.is_dir(follow_symlinks=False):
+			return devShmPathShouldInclude(top_entry, cutoff)
+		# For a first-level directory we don't let its timestamp being newer
+		# exclude it from being removed -- only child files can do that.
+		# Walk the subtree with an explicit stack and stop as soon as any
+		# descendant file excludes the directory.
+		#
+		# Each directory is opened and listed by descriptor, so the stat()
+		# of each of its entries is an fstatat() relative to that descriptor
+		# rather than a lookup of the full path:
+		is_included = devShmPathShouldInclude(top_entry, cutoff)
+		dir_stack = [top_entry.path]
+		while dir_stack:
+			dir_path = dir_stack.pop()
+			try:
+				dir_fd = os.open(dir_path, subtree_dir_open_flags)
+			except OSError:
+				# Same as os.walk():  directories we can't list (or that
+				# vanished) are skipped:
+				continue
+			try:
+				with os.scandir(dir_fd) as entries:
+					for entry in entries:
+						if entry.is_dir(follow_symlinks=False):
+							dir_stack.append(dir_path + b'/' + os.fsencode(entry.name))
+							continue
+						should_include = devShmPathShouldInclude(entry, cutoff)
+						if should_include is None:
+							# Vanished since it was listed:
+							continue
+						if not should_include:
+							return False
+						is_included = True
+			finally:
+				os.close(dir_fd)
+		return is_included
+
+	return devShmEntityShouldInclude
 
-# Default to Unix epoch for cutoff -- which means everything would be
-# excluded.  Later in this script this will get changed to a more
-# useful value.
-cutoff_timestamp = 0
-special_cutoff_timestamp = 0
+#
+##
+#
 
-# Number of seconds that special-treatments files must be newer than:
-special_cutoff_threshold = 3600
+def recursiveRm(path):
+	# Equivalent to "rm -rf <path>" but without spawning a process:  a
+	# directory is removed with shutil.rmtree(), anything else (including
+	# a symlink to a directory) is simply unlinked.  A path that has
+	# already vanished is not an error.  The path may be str or bytes.
+	try:
+		if os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path)
+		else:
+			os.unlink(path)
+	except OSError as E:
+		if E.errno == errno.ENOENT and not os.path.lexists(path):
+			return
+		raise RuntimeError('failed to remove ' + os.fsdecode(path) + ': ' + str(E).replace('\n', '; '))
+	except Exception as E:
+		raise RuntimeError('failed to remove ' + os.fsdecode(path) + ': ' + str(E).replace('\n', '; '))
 
-def devShmPathShouldInclude_Strict(path):
-	s = os.stat(path)
-	if s and s.st_mtime > cutoff_timestamp or s.st_ctime > cutoff_timestamp or s.st_atime > cutoff_timestamp:
-		return False
-	return True
-
-def devShmPathShouldInclude_SpecialTreatment(path):
-	if 'psm2_shm' in path or 'vader_segment' in path:
-		s = os.stat(path)
-		if s and s.st_mtime > special_cutoff_timestamp or s.st_ctime > special_cutoff_timestamp or s.st_atime > special_cutoff_timestamp:
-			return False
-	else:
-		return devShmPathShouldInclude_Strict(path)
-	return True
+# Removals are independent and spend their time in unlink()/rmdir() with
+# the GIL released, so several are done at once -- but not so many that
+# they just contend for the tmpfs locks:
+removal_max_workers = 8
 
-devShmPathShouldInclude = devShmPathShouldInclude_SpecialTreatment
+def recursiveRmNoRaise(path):
+	# For use with map():  None on success, otherwise the error message.
+	try:
+		recursiveRm(path)
+	except Exception as E:
+		return str(E)
+	return None
 
 #
 ##
 #
 
-def recursiveRm(path):
-	try:
-		rm_process = subprocess.Popen(['rm', '-rf', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		(rm_stdout, rm_stderr) = rm_process.communicate()
-		if rm_process.returncode != 0:
-			raise RuntimeError('failed to remove ' + path + ': ' + rm_stderr.replace('\n', '; '))
-	except Exception as E:
-		raise RuntimeError('failed to remove ' + path + ': ' + str(E).replace('\n', '; '))
+# In daemon mode these are blocked and waited for with sigtimedwait():
+termination_signals = {signal.SIGTERM, signal.SIGINT}
+
+def unblockTerminationSignals():
+	# Children inherit the signal mask across exec, so a child (lsof) must
+	# have the termination signals unblocked or it could not be stopped:
+	signal.pthread_sigmask(signal.SIG_UNBLOCK, termination_signals)
+
+def firstLevelDevShmPath(path, prefix):
+	# The first-level path under prefix (which must end with a '/') that
+	# contains path, or None if path isn't under prefix.  Plain slicing is
+	# all it takes, no regex needed.
+	if not path.startswith(prefix):
+		return None
+	name = path[len(prefix):].partition(b'/')[0]
+	if name:
+		return prefix + name
+	return None
+
+def procInUseDevShmEntities(dev_shm_prefix, inuse_shm_entities):
+	# Does the same job as "lsof +D <dev_shm_prefix>" without the extra
+	# process:  for every process in /proc check its cwd, root, and exe
+	# links, its open file descriptors, and its memory-mapped files (PSM2
+	# and vader segments are often mapped with no descriptor left open).
+	# Processes can exit at any point while we look, so errors reading
+	# any of those are ignored.  Everything is done in bytes, so the
+	# dev_shm_prefix must be bytes, too.
+	prefix = dev_shm_prefix + b'/'
+	def addInUsePath(path):
+		# Unlinked files that are still open or mapped show up as
+		# "<path> (deleted)"; lsof +D doesn't report those and nothing under
+		# /dev/shm is holding them, so skip them rather than strip the suffix
+		# (which would protect a new file that reuses the name):
+		if path.endswith(b' (deleted)'):
+			return
+		first_level_path = firstLevelDevShmPath(path, prefix)
+		if first_level_path is not None:
+			inuse_shm_entities.add(first_level_path)
+
+	with os.scandir(b'/proc') as proc_entries:
+		for proc_entry in proc_entries:
+			if not proc_entry.name.isdigit():
+				continue
+			proc_path = proc_entry.path
+			for link_name in (b'/cwd', b'/root', b'/exe'):
+				try:
+					addInUsePath(os.readlink(proc_path + link_name))
+				except OSError:
+					pass
+			try:
+				with os.scandir(proc_path + b'/fd') as fd_entries:
+					for fd_entry in fd_entries:
+						try:
+							addInUsePath(os.readlink(fd_entry.path))
+						except OSError:
+							pass
+			except OSError:
+				pass
+			try:
+				with open(proc_path + b'/maps', 'rb') as maps_fptr:
+					for line in maps_fptr:
+						# address perms offset dev inode [pathname]
+						fields = line.split(None, 5)
+						if len(fields) == 6:
+							addInUsePath(fields[5].rstrip(b'\n'))
+			except OSError:
+				pass
 
 #
 ##
 #
 
+time_string_regex = re.compile(r'^([+-]?(([0-9]*(\.[0-9]+))|([0-9]+(\.[0-9]*)?)))([smhdSMHD])?$')
+time_unit_multipliers = { 's':1, 'S':1, 'm':60, 'M':60, 'h':3600, 'H':3600, 'd':86400, 'D':86400 }
+
 def timeStringToSeconds(time_str, implied_unit = 's'):
-	unit_multipliers = { 's':1, 'S':1, 'm':60, 'M':60, 'h':3600, 'H':3600, 'd':86400, 'D':86400 }
 	try:
-		time_bits = re.match(r'^([+-]?(([0-9]*(\.[0-9]+))|([0-9]+(\.[0-9]*)?)))([smhdSMHD])?$', time_str)
+		time_bits = time_string_regex.match(time_str)
 		if not time_bits:
 			return None
 		seconds = float(time_bits.group(1))
 		if time_bits.group(7):
 			implied_unit = time_bits.group(7)
-		if implied_unit in unit_multipliers:
-			seconds *= unit_multipliers[implied_unit]
+		if implied_unit in time_unit_multipliers:
+			seconds *= time_unit_multipliers[implied_unit]
 		else:
 			return None
 		return seconds
-	except:
+	except (TypeError, ValueError, AttributeError):
 		return None
 
 #
@@ -151,8 +279,12 @@ cli_parser.add_argument('--dev-shm-prefix', '-P', metavar='<path>',
 		help='mountpoint of the shm file system (default: /dev/shm)'
 	)
 cli_parser.add_argument('--lsof', '-L', metavar='<cmd>',
-		default='lsof', dest='lsof',
-		help='path to the lsof command; if the value is a bare command (not a path) then lsof commands are executed in a shell (default: lsof)'
+		default=None, dest='lsof',
+		help='path to the lsof command; if the value is a bare command (not a path) then lsof commands are executed in a shell; giving this option implies --use-lsof (default: lsof, used only with --use-lsof or when /proc is not present)'
+	)
+cli_parser.add_argument('--use-lsof',
+		default=False, action='store_true', dest='is_lsof_forced',
+		help='use lsof to find in-use files even if /proc is available (by default lsof is only used when /proc is not present or --lsof is given)'
 	)
 cli_parser.add_argument('--show-log-timestamps', '-t',
 		default=False, action='store_true', dest='show_log_timestamps',
@@ -178,6 +310,18 @@ cli_parser.add_argument('--daemon-period',
 		metavar='<period>', default='86400', dest='daemon_period',
 		help='wake to re-check on the given period; integer or floating-point values are acceptable with optional unit of s/m/h/d (default: s)'
 	)
+cli_parser.add_argument('--daemon-period-min',
+		metavar='<period>', dest='daemon_period_min',
+		help='after a check that found items to remove the wake period is halved, but never below this period; checks in dry-run mode never count as having found items; same format as --daemon-period (default: the --daemon-period value, or --daemon-period-max if that is smaller)'
+	)
+cli_parser.add_argument('--daemon-period-max',
+		metavar='<period>', dest='daemon_period_max',
+		help='after a check that found nothing to remove the wake period is doubled, but never above this period; same format as --daemon-period (default: the --daemon-period value, or --daemon-period-min if that is larger)'
+	)
+cli_parser.add_argument('--daemon-full-scan-every',
+		metavar='<N>', type=int, default=1, dest='daemon_full_scan_every',
+		help='in daemon mode, skip a check if the shm directory itself has not been modified since the previous check, but always perform every N-th check in full; orphans left by processes that exit without touching the shm directory are only found by full checks (default: 1, every check is a full check)'
+	)
 cli_parser.add_argument('--pid-file',
 		metavar='<filename>', default='/var/run/shm-cleanup.pid', dest='pid_file',
 		help='in daemon mode, write our pid to this file (default: /var/run/shm-cleanup.pid)'
@@ -220,14 +364,22 @@ dev_shm_prefix = os.path.realpath(cli_args.dev_shm_prefix)
 if not os.path.isdir(dev_shm_prefix):
 	logging.critical('shm prefix path "{:s}" does not exist'.format(cli_args.dev_shm_prefix))
 	sys.exit(1)
-# Generate the regex:
-firstLevelDevShmRegex = re.compile('({:s}/[^/]+)'.format(dev_shm_prefix))
+
+#
+# Find in-use files via /proc if we can, otherwise lsof:
+#
+if cli_args.is_lsof_forced or cli_args.lsof or not os.path.isdir('/proc/self/fd'):
+	lsof = cli_args.lsof or 'lsof'
+	logging.info('in-use files under %s will be found using lsof', dev_shm_prefix)
+else:
+	lsof = None
+	logging.info('in-use files under %s will be found using /proc', dev_shm_prefix)
 
 #
 # No special treatment?
 #
 if cli_args.is_special_treatment_disabled:
-	devShmPathShouldInclude = devShmPathShouldInclude_Strict
+	is_special_treatment_enabled = False
 	logging.info('no special treatment of PSM2 and vader segment files')
 
 #
@@ -240,10 +392,21 @@ if age_threshold is None:
 logging.info('age threshold of %d second(s)', age_threshold)
 
 #
-# This function does the actual scan-and-cleanup work:
+# This function does the actual scan-and-cleanup work; if lsof is None then
+# in-use files are found by scanning /proc.  If since_timestamp is provided
+# and the shm directory has not been modified since then, nothing is done.
+# Returns the number of first-level entities it found to remove (always 0
+# in dry-run mode, since nothing is actually removed):
 #
-def do_scan(dev_shm_prefix, lsof):
-	global cutoff_timestamp, special_cutoff_timestamp
+def do_scan(dev_shm_prefix, lsof, since_timestamp = None):
+	if since_timestamp is not None:
+		try:
+			if os.stat(dev_shm_prefix).st_mtime < since_timestamp:
+				logging.info('no changes to %s since the last check, skipping scan', dev_shm_prefix)
+				return 0
+		except OSError as E:
+			logging.warning('unable to stat %s: %s', dev_shm_prefix, str(E))
+
 	#
 	# Scan /dev/shm for all entities with modification timestamps greater than age_threshold
 	# seconds ago:
@@ -252,42 +415,110 @@ def do_scan(dev_shm_prefix, lsof):
 	special_cutoff_timestamp = time.time() - special_cutoff_threshold
 	logging.info('cutoff timestamp for modification timestamps, standard: %d', cutoff_timestamp)
 	logging.info('cutoff timestamp for modification timestamps, specials: %d', special_cutoff_timestamp)
-	include_shm_entities = newSet()
-	exclude_shm_entities = newSet()
-	for root_dir, dirs, files in os.walk(dev_shm_prefix, topdown=False):
-		# Check files:
-		for file in files:
-			p = os.path.join(root_dir, file)
-			if devShmPathShouldInclude(p):
-				include_shm_entities.add(firstLevelDevShmPath(p))
+	devShmEntityShouldInclude = makeDevShmEntityShouldInclude(cutoff_timestamp, special_cutoff_timestamp)
+
+	#
+	# All paths we collect are kept as bytes -- that's what lsof writes and
+	# it saves decoding every name we see; they only get decoded for
+	# logging:
+	#
+	dev_shm_prefix_bytes = os.fsencode(dev_shm_prefix)
+
+	#
+	# Make sure we're running as root:
+	#
+	if os.getuid() != 0:
+		logging.critical('scanning for active {:s} files requires root privileges'.format(dev_shm_prefix))
+		sys.exit(1)
+
+	#
+	# Find all open files under /dev/shm.  This is started before our
+	# own scan of /dev/shm so that the two traversals overlap rather than
+	# running one after the other:  a background thread scans first-level
+	# paths of in-use entities into a set while we're busy below.
+	#
+	# Any exception in the background thread is collected and re-raised
+	# once the thread is joined:  removing anything based on an in-use set
+	# that wasn't completely built could remove files that are in use.
+	#
+	inuse_shm_entities = set()
+	inuse_scan_errors = []
+	def runInUseScan(scanFunction, *args):
+		try:
+			scanFunction(*args)
+		except BaseException as E:
+			inuse_scan_errors.append(E)
+
+	if lsof is None:
+		logging.debug('scanning /proc for in-use files')
+		inuse_thread = threading.Thread(target=runInUseScan, args=(procInUseDevShmEntities, dev_shm_prefix_bytes, inuse_shm_entities))
+		lsof_process = None
+	else:
+		#
+		# Ask lsof to show us all open files under /dev/shm.  We can't use
+		# check_output() because lsof +D will return non-zero due to files
+		# present under /dev/shm that aren't in use :-\
+		#
+		try:
+			cmd_seq = [lsof, '-lnP', '-Fn', '+D', dev_shm_prefix]
+			if os.sep in lsof:
+				logging.debug('performing lsof command "{:s}"'.format(' '.join(cmd_seq)))
+				lsof_process = subprocess.Popen(cmd_seq, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, preexec_fn=unblockTerminationSignals)
 			else:
-				exclude_shm_entities.add(firstLevelDevShmPath(p))
-		# Once we get to /dev/shm, scan the directories, too; but we
-		# don't let a directory's timestamp being newer exclude it from
-		# being removed -- only child files can do that:
-		if root_dir == dev_shm_prefix:
-			for dir in dirs:
-				p = os.path.join(root_dir, dir)
-				if devShmPathShouldInclude(p):
-					include_shm_entities.add(p)
+				logging.debug('performing lsof command "{:s}" in a shell'.format(' '.join(cmd_seq)))
+				lsof_process = subprocess.Popen(' '.join(cmd_seq), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True, preexec_fn=unblockTerminationSignals)
+		except Exception as E:
+			logging.error(str(E))
+			sys.exit(1)
+
+		#
+		# We only want to check the stdout from lsof, which is asked to
+		# produce just the name field (-Fn) of each open file:
+		#
+		lsof_prefix = dev_shm_prefix_bytes + b'/'
+		def drainLsofOutput():
+			# Name-only output is small enough to read in one go and split
+			# into lines in a single call:
+			for line in lsof_process.stdout.read().split(b'\n'):
+				# In field mode the only lines we care about are name fields
+				# (the "p" process id lines are ignored):
+				if line.startswith(b'n'):
+					first_level_path = firstLevelDevShmPath(line[1:], lsof_prefix)
+					if first_level_path is not None:
+						inuse_shm_entities.add(first_level_path)
+		inuse_thread = threading.Thread(target=runInUseScan, args=(drainLsofOutput,))
+	inuse_thread.daemon = True
+	inuse_thread.start()
 
 	#
-	# Get the set difference, include_shm_entities / exclude_shm_entities:
+	# Each first-level entity is fully decided before we move on to the
+	# next, so excluded entities never make it into the set and no
+	# exclusion set (or set difference) is needed:
 	#
-	include_shm_entities -= exclude_shm_entities
+	include_shm_entities = set()
+	with os.scandir(dev_shm_prefix_bytes) as top_entries:
+		for top_entry in top_entries:
+			# The first-level path is the entry itself, no need to derive
+			# it from each descendant:
+			if devShmEntityShouldInclude(top_entry):
+				include_shm_entities.add(top_entry.path)
 
 	#
 	# Count and summarize how many items we see:
 	#
+	basename_offset = len(dev_shm_prefix_bytes) + 1
 	def summarizeDevShmEntitySet(theSet, whatAreThey):
 		vader_count = 0
 		psm_count = 0
 		unknown_count = 0
 		unknown_paths = []
 		for p in theSet:
-			if 'psm2_shm' in p:
+			# Everything in theSet is a first-level path, so its basename
+			# is just what follows the prefix:
+			basename = p[basename_offset:]
+			if basename.startswith(b'psm2_shm'):
 				psm_count += 1
-			elif 'vader_segment' in p:
+			elif basename.startswith(b'vader_segment'):
 				vader_count += 1
 			else:
 				unknown_count += 1
@@ -298,7 +529,7 @@ def do_scan(dev_shm_prefix, lsof):
 			logging.warning('  Open MPI vader segments: %8d', vader_count)
 			logging.warning('  Unidentified items:      %8d', len(theSet) - (psm_count + vader_count))
 			for p in unknown_paths:
-				logging.warning('      %s', p)
+				logging.warning('      %s', os.fsdecode(p))
 		else:
 			logging.info('found %d %s', len(theSet), whatAreThey)
 			if psm_count + vader_count > 0:
@@ -308,43 +539,13 @@ def do_scan(dev_shm_prefix, lsof):
 	summarizeDevShmEntitySet(include_shm_entities, 'removable first-level entities under ' + dev_shm_prefix)
 
 	#
-	# Make sure we're running as root:
-	#
-	if os.getuid() != 0:
-		logging.critical('scanning for active {:s} files requires root privileges'.format(dev_shm_prefix))
-		sys.exit(1)
-
-	#
-	# Ask lsof to show us all open files under /dev/shm.  We can't use
-	# check_output() because lsof +D will return non-zero due to files
-	# present under /dev/shm that aren't in use :-\
+	# Wait for the in-use scan to finish:
 	#
-	try:
-		cmd_seq = [lsof, '-lnP', '+D', dev_shm_prefix]
-		if os.sep in lsof:
-			logging.debug('performing lsof command "{:s}"'.format(' '.join(cmd_seq)))
-			lsof_process = subprocess.Popen(cmd_seq, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		else:
-			logging.debug('performing lsof command "{:s}" in a shell'.format(' '.join(cmd_seq)))
-			lsof_process = subprocess.Popen(' '.join(cmd_seq), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-	except Exception as E:
-		logging.error(str(E))
-		sys.exit(1)
-
-	#
-	# We only want to check the stdout from lsof.  Scan first-level
-	# paths into a set.
-	#
-	inuse_shm_entities = newSet()
-	while True:
-		line = lsof_process.stdout.readline()
-		if line != b'':
-			m = firstLevelDevShmRegex.search(line.strip())
-			if m:
-				inuse_shm_entities.add(m.group(1))
-		else:
-			break
-	lsof_process.wait()
+	inuse_thread.join()
+	if lsof_process is not None:
+		lsof_process.wait()
+	if inuse_scan_errors:
+		raise RuntimeError('scan for in-use files under {:s} failed: {:s}'.format(dev_shm_prefix, str(inuse_scan_errors[0])))
 
 	#
 	# Count and summarize how many items we see in-use:
@@ -366,17 +567,28 @@ def do_scan(dev_shm_prefix, lsof):
 		if cli_args.is_dry_run:
 			logging.info('dry-run summary of actions that would be performed')
 			for p in remove_shm_entities:
-				logging.info('  rm -rf %s', p)
+				logging.info('  rm -rf %s', os.fsdecode(p))
 		else:
 			logging.info('processing removal list')
-			for p in remove_shm_entities:
-				try:
-					recursiveRm(p)
-					logging.info('  OK   rm -rf %s', p)
-				except Exception as E:
-					logging.info('  FAIL rm -rf %s : %s', p, str(E))
+			removed_paths = []
+			remove_paths = list(remove_shm_entities)
+			with concurrent.futures.ThreadPoolExecutor(max_workers=min(removal_max_workers, len(remove_paths))) as executor:
+				for p, error in zip(remove_paths, executor.map(recursiveRmNoRaise, remove_paths)):
+					if error is None:
+						removed_paths.append(p)
+					else:
+						logging.error('  FAIL rm -rf %s : %s', os.fsdecode(p), error)
+			#
+			# Successes are summarized rather than logged one-by-one:
+			#
+			logging.info('removed %d of %d first-level entities under %s', len(removed_paths), len(remove_shm_entities), dev_shm_prefix)
+			if removed_paths and logging.getLogger().isEnabledFor(logging.DEBUG):
+				logging.debug('  OK   rm -rf %s', ' '.join([os.fsdecode(p) for p in removed_paths]))
 	else:
 		logging.warning('nothing to be removed from ' + dev_shm_prefix)
+	if cli_args.is_dry_run:
+		return 0
+	return len(remove_shm_entities)
 
 
 #
@@ -387,10 +599,54 @@ if cli_args.is_daemon:
 	# Determine how long to wait between checks:
 	#
 	daemon_period = timeStringToSeconds(cli_args.daemon_period, implied_unit = 's')
+	if daemon_period is None:
+		logging.error('invalid daemon period specified: %s', cli_args.daemon_period)
+		sys.exit(2)
 	if daemon_period < 30:
 		logging.warning('daemon wake period limited to 30s (instead of %ds)', daemon_period)
 		daemon_period = 30
+
+	#
+	# The wake period adapts to how productive each check was, within
+	# these bounds.  A bound that isn't specified defaults to the daemon
+	# period (limited by the other bound, if that was specified); with
+	# neither specified the period is fixed.  A period outside the bounds
+	# starts at the nearest one:
+	#
+	daemon_period_min = None
+	if cli_args.daemon_period_min:
+		daemon_period_min = timeStringToSeconds(cli_args.daemon_period_min, implied_unit = 's')
+		if daemon_period_min is None:
+			logging.error('invalid minimum daemon period specified: %s', cli_args.daemon_period_min)
+			sys.exit(2)
+		if daemon_period_min < 30:
+			logging.warning('minimum daemon wake period limited to 30s (instead of %ds)', daemon_period_min)
+			daemon_period_min = 30
+	daemon_period_max = None
+	if cli_args.daemon_period_max:
+		daemon_period_max = timeStringToSeconds(cli_args.daemon_period_max, implied_unit = 's')
+		if daemon_period_max is None:
+			logging.error('invalid maximum daemon period specified: %s', cli_args.daemon_period_max)
+			sys.exit(2)
+		if daemon_period_max < 30:
+			logging.warning('maximum daemon wake period limited to 30s (instead of %ds)', daemon_period_max)
+			daemon_period_max = 30
+	if daemon_period_min is None:
+		daemon_period_min = daemon_period if daemon_period_max is None else min(daemon_period, daemon_period_max)
+	if daemon_period_max is None:
+		daemon_period_max = max(daemon_period, daemon_period_min)
+	if daemon_period_min > daemon_period_max:
+		logging.error('minimum daemon period (%ds) exceeds the maximum (%ds)', daemon_period_min, daemon_period_max)
+		sys.exit(2)
+	daemon_period = min(daemon_period_max, max(daemon_period_min, daemon_period))
 	logging.info('daemonizing on a period of %d second(s)', daemon_period)
+	if daemon_period_min < daemon_period_max:
+		logging.info('daemon period will adapt between %d and %d second(s)', daemon_period_min, daemon_period_max)
+	if cli_args.daemon_full_scan_every < 1:
+		logging.error('invalid full scan interval specified: %d', cli_args.daemon_full_scan_every)
+		sys.exit(2)
+	if cli_args.daemon_full_scan_every > 1:
+		logging.info('checks will be skipped if %s is unchanged, except every %d check(s)', dev_shm_prefix, cli_args.daemon_full_scan_every)
 
 	#
 	# Get pid file setup:
@@ -415,41 +671,66 @@ if cli_args.is_daemon:
 		logging.info('pid written to %s', pid_file)
 
 	#
-	# We want to ignore SIGHUP instead of being killed and remove
-	# our pid file on termination:
+	# We want to ignore SIGHUP instead of being killed:
 	#
-	import signal
 	signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-	def termination_handler(signum, frame):
+	def removePidFile():
 		if pid_file is not None and os.path.exists(pid_file):
 			try:
 				os.remove(pid_file)
 				logging.info('removed pid file %s', pid_file)
 			except Exception as E:
 				logging.critical('could not remove pid file %s: %s', pid_file, str(E))
-		logging.info('exiting on signal %d', signum)
-		sys.exit(0)
-	signal.signal(signal.SIGTERM, termination_handler)
-	signal.signal(signal.SIGINT, termination_handler)
+
+	#
+	# SIGTERM and SIGINT are blocked and instead collected by sigtimedwait()
+	# while we wait for the next check, so they end the wait immediately.
+	# One that arrives during a check is held until that check completes.
+	#
+	signal.pthread_sigmask(signal.SIG_BLOCK, termination_signals)
 
 	#
 	# Enter our runloop; only being killed will break us out:
 	#
+	last_check_timestamp = None
+	check_count = 0
 	try:
 		while True:
-			do_scan(dev_shm_prefix, cli_args.lsof)
-			time.sleep(daemon_period)
-	except:
-		pass
-	if pid_file is not None and os.path.exists(pid_file):
-		try:
-			os.remove(pid_file)
-			logging.info('removed pid file %s', pid_file)
-		except Exception as E:
-			logging.critical('could not remove pid file %s: %s', pid_file, str(E))
+			check_timestamp = time.time()
+			try:
+				if last_check_timestamp is None or check_count % cli_args.daemon_full_scan_every == 0:
+					remove_count = do_scan(dev_shm_prefix, lsof)
+				else:
+					remove_count = do_scan(dev_shm_prefix, lsof, since_timestamp = last_check_timestamp)
+			except Exception as E:
+				# A failed check shouldn't take the daemon down; try again
+				# (in full) after the current period:
+				logging.error('check of %s failed: %s', dev_shm_prefix, str(E))
+				remove_count = None
+			if remove_count is None:
+				last_check_timestamp = None
+			else:
+				last_check_timestamp = check_timestamp
+				if remove_count > 0:
+					daemon_period = max(daemon_period_min, daemon_period / 2)
+				else:
+					daemon_period = min(daemon_period_max, daemon_period * 2)
+			check_count += 1
+			logging.info('next check in %d second(s)', daemon_period)
+			deadline = time.monotonic() + daemon_period
+			signal_info = None
+			remaining = daemon_period
+			while signal_info is None and remaining > 0:
+				signal_info = signal.sigtimedwait(termination_signals, remaining)
+				remaining = deadline - time.monotonic()
+			if signal_info is not None:
+				logging.info('exiting on signal %d', signal_info.si_signo)
+				break
+	finally:
+		removePidFile()
 else:
 	#
 	# Single run only:
 	#
-	do_scan(dev_shm_prefix, cli_args.lsof)
+	do_scan(dev_shm_prefix, lsof)